@@ -5,7 +5,15 @@ import sys
 
 from peewee import *
 
-db = SqliteDatabase('inventory.db')
+db = SqliteDatabase('inventory.db', pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,
+    'temp_store': 'memory',
+    'mmap_size': 268435456,
+    'busy_timeout': 30000})
+
+TODAY = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
 
 
 class InputError(Exception):
@@ -29,36 +37,81 @@ def initialize():
     db.create_tables([Product], safe=True)
 
 
+def shutdown():
+    """Let SQLite refresh its query planner statistics and close the database"""
+    db.execute_sql('PRAGMA optimize')
+    db.close()
+
+
 def add_entry(dictionary):
-    Product.create(
+    return Product.create(
         product_name=dictionary['product_name'],
         product_quantity=int(dictionary['product_quantity']),
         product_price=dictionary['product_price'],
-        date_updated=(dictionary['date_updated']))
+        date_updated=(dictionary['date_updated'])).product_id
 
 
 def update_duplicate(dictionary, existing_product):
-    existing_product.product_quantity = int(dictionary['product_quantity'])
-    existing_product.product_price = dictionary['product_price']
-    existing_product.date_updated = dictionary['date_updated']
-    existing_product.save()
+    Product.update(
+        product_quantity=int(dictionary['product_quantity']),
+        product_price=dictionary['product_price'],
+        date_updated=dictionary['date_updated']
+        ).where(Product.product_id == existing_product.product_id).execute()
 
 
 def add_csv():
+    """Load inventory.csv, keeping the most recently updated row per product"""
+    existing = dict(Product.select(Product.product_name, Product.date_updated).tuples().iterator())
     with open('inventory.csv', newline='') as csvfile:
-        inventory_reader = csv.DictReader(csvfile, delimiter=",")
-        rows = list(inventory_reader)
-        for row in rows:
-            row['date_updated'] = datetime.datetime.strptime(row['date_updated'], '%m/%d/%Y')
-            row['product_price'] = round(float(row['product_price'].strip('$'))*100)
-            try:
-                add_entry(row)
-            except IntegrityError:
-                existing_product = Product.get(Product.product_name == row['product_name'])
-                if row['date_updated'] >= existing_product.date_updated:
-                    update_duplicate(row, existing_product)
-                else:
-                    pass
+        inventory_reader = csv.reader(csvfile, delimiter=",")
+        header = next(inventory_reader)
+        name_i = header.index('product_name')
+        qty_i = header.index('product_quantity')
+        price_i = header.index('product_price')
+        date_i = header.index('date_updated')
+        parsed = ((row[name_i], row[qty_i], row[price_i], _parse_mdy(row[date_i]))
+                  for row in inventory_reader)
+        rows = ((name, int(qty), _parse_price(price), date)
+                for name, qty, price, date in parsed
+                if date >= existing.get(name, date))
+        fields = [Product.product_name, Product.product_quantity, Product.product_price, Product.date_updated]
+        with db.atomic():
+            for batch in chunked(rows, 100):
+                Product.insert_many(batch, fields=fields).on_conflict(
+                    conflict_target=[Product.product_name],
+                    update={
+                        Product.product_quantity: EXCLUDED.product_quantity,
+                        Product.product_price: EXCLUDED.product_price,
+                        Product.date_updated: EXCLUDED.date_updated},
+                    where=(EXCLUDED.date_updated >= Product.date_updated)).execute()
+
+
+def _parse_mdy(string):
+    month, day, year = string.split('/')
+    return datetime.datetime(int(year), int(month), int(day))
+
+
+def _parse_price(string):
+    """Convert a '$#.##' price string to integer cents"""
+    string = string.lstrip('$')
+    dot = string.find('.')
+    if dot < 0:
+        whole, frac = string, ''
+    else:
+        whole, frac = string[:dot], string[dot + 1:]
+    if len(frac) > 2:
+        raise InputError("Invalid entry. You may only enter up to two decimal places.")
+    if not (whole + frac).isdigit():
+        raise ValueError("Invalid price: {}".format(string))
+    return int(whole or 0) * 100 + int((frac + '00')[:2])
+
+
+def _fmt_date(date):
+    return f"{date.month:02d}/{date.day:02d}/{date.year}"
+
+
+def _fmt_cents(cents):
+    return "$%d.%02d" % divmod(cents, 100)
 
 
 def print_heading(heading):
@@ -68,31 +121,36 @@ def print_heading(heading):
 
 
 def print_product_details(selected_product):
-    product = Product.get(Product.product_id == selected_product)
-    print("ID:", product.product_id, " | ",
-          "NAME:", product.product_name, " | ",
-          "QUANTITY:", product.product_quantity, " | ",
-          "PRICE: $%.2f" % float(product.product_price * .01), " | ",
-          "Date Updated:", product.date_updated.strftime('%m/%d/%Y'))
+    product = Product.select(
+        Product.product_id,
+        Product.product_name,
+        Product.product_quantity,
+        Product.product_price,
+        Product.date_updated
+        ).where(Product.product_id == selected_product).dicts().get()
+    print("ID:", product['product_id'], " | ",
+          "NAME:", product['product_name'], " | ",
+          "QUANTITY:", product['product_quantity'], " | ",
+          "PRICE: " + _fmt_cents(product['product_price']), " | ",
+          "Date Updated:", _fmt_date(product['date_updated']))
 
 
 def last_product_id():
     """Find final Product ID for View & Print Methods"""
-    return Product.select().order_by(Product.product_id.desc()).get()
+    return Product.select(fn.MAX(Product.product_id)).scalar()
 
 
 def menu_loop():
     """Show the menu"""
-    choice = None
     heading = "INVENTORY DATABASE MENU"
-    while choice not in menu:
-        print_heading(heading)
-        for key, value in menu.items():
-            print('{}) {}'.format(key, value.__doc__))
-        choice = input('\nMenu Action: ').lower().strip()
-        if choice not in menu:
-            print("\nInput Error. Please enter a valid letter per the list of menu options.")
-    if choice in menu:
+    while True:
+        choice = None
+        while choice not in VALID:
+            print_heading(heading)
+            print(MENU_PROMPT)
+            choice = input('\nMenu Action: ').lower().strip()
+            if choice not in VALID:
+                print("\nInput Error. Please enter a valid letter per the list of menu options.")
         menu[choice]()
 
 
@@ -109,9 +167,10 @@ def view_product_details():
     """View details of a specific product."""
     heading = "View Product Details"
     print_heading(heading)
+    max_id = last_product_id()
     while True:
         try:
-            selected_product = input("Enter Product ID to view details (1 - {}): ".format(last_product_id()))
+            selected_product = input("Enter Product ID to view details (1 - {}): ".format(max_id))
             print_product_details(selected_product)
             if back_to_menu("\nWould you like to view more products (y/n): ") == 'n':
                 break
@@ -119,53 +178,46 @@ def view_product_details():
             print("\nThis Product ID does not exist. Please try again.")
         except ValueError:
             print("\nEntry must be a numeric. Please try again.")
-    menu_loop()
 
 
-def decimal_check(string):
-    index = string.index(".")
-    if len(string[index:]) > 3:
-        return False
-    else:
-        return True
+def _required(string):
+    if len(string) == 0:
+        raise ValueError("Empty entry")
+    return string
+
+
+def _prompt(prompt, validate, err):
+    while True:
+        try:
+            return validate(input(prompt))
+        except ValueError:
+            print(err)
+        except InputError as error:
+            print("{}".format(error))
 
 
 def add_new_product():
     """Add a new product to the database."""
+    heading = "Add A New Product"
+    print_heading(heading)
     while True:
-        heading = "Add A New Product"
-        print_heading(heading)
-        new_product_details = {'product_name': ""}
-        while len(new_product_details['product_name']) == 0:
-            new_product_details['product_name'] = input("Enter a product name: ")
-            if len(new_product_details['product_name']) == 0:
-                print("Product Name is a required field.")
-        while True:
-            try:
-                new_product_details['product_price'] = input("Enter a product price ($#.##): ")
-                if not decimal_check(new_product_details['product_price']):
-                    raise InputError("Invalid entry. You may only enter up to two decimal places.")
-                new_product_details['product_price'] = round(float(new_product_details['product_price'].strip('$'))*100)
-                break
-            except ValueError:
-                print("Invalid Entry. Enter dollar amount in the format of '$#.##'")
-            except InputError as err:
-                print("{}".format(err))
-        while True:
-            try:
-                new_product_details['product_quantity'] = int(input("Enter a product quantity: "))
-                break
-            except ValueError:
-                print("Invalid Entry. Enter a numeric.")
-        new_product_details['date_updated'] = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        try:
-            add_entry(new_product_details)
+        new_product_details = {
+            'product_name': _prompt("Enter a product name: ", _required,
+                                    "Product Name is a required field."),
+            'product_price': _prompt("Enter a product price ($#.##): ", _parse_price,
+                                     "Invalid Entry. Enter dollar amount in the format of '$#.##'"),
+            'product_quantity': _prompt("Enter a product quantity: ", int,
+                                        "Invalid Entry. Enter a numeric."),
+            'date_updated': TODAY
+            }
+        existing_product = Product.get_or_none(Product.product_name == new_product_details['product_name'])
+        if existing_product is None:
+            new_id = add_entry(new_product_details)
             print("\nThis product has been added to the database.")
-            print_product_details(last_product_id())
+            print_product_details(new_id)
             if back_to_menu("\nWould you like to add another product (y/n): ") == 'n':
                 break
-        except IntegrityError:
-            existing_product = Product.get(Product.product_name == new_product_details['product_name'])
+        else:
             if new_product_details['date_updated'] >= existing_product.date_updated:
                 print("\nA product with this name already exists:")
                 print_product_details(existing_product.product_id)
@@ -187,7 +239,6 @@ def add_new_product():
                       "Therefore, your entry was not added.")
             if back_to_menu("Would you like to add another product (y/n): ") == 'n':
                 break
-    menu_loop()
 
 
 def backup_database():
@@ -201,17 +252,21 @@ def backup_database():
             'product_quantity',
             'date_updated'
             ]
-        inventory_writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        inventory_writer.writeheader()
-        for product in Product.select():
-            inventory_writer.writerow({
-                'product_name': product.product_name,
-                'product_price': "$%.2f" % float(product.product_price * .01),
-                'product_quantity': product.product_quantity,
-                'date_updated': product.date_updated.strftime('%m/%d/%Y')
-                })
+        inventory_writer = csv.writer(csvfile)
+        inventory_writer.writerow(fieldnames)
+        products = Product.select(
+            Product.product_name,
+            Product.product_price,
+            Product.product_quantity,
+            Product.date_updated
+            ).dicts().iterator()
+        inventory_writer.writerows(
+            (product['product_name'],
+             _fmt_cents(product['product_price']),
+             product['product_quantity'],
+             _fmt_date(product['date_updated']))
+            for product in products)
     print("A backup inventory file has been created.")
-    menu_loop()
 
 
 def exit_program():
@@ -220,11 +275,10 @@ def exit_program():
     while done not in ['y', 'n']:
         done = input("Are you sure you want to exit the program? (y/n): ").lower()
         if done == 'y':
+            shutdown()
             sys.exit("Goodbye.")
         if done not in ['y', 'n']:
             print("Invalid entry. Please try again.")
-        else:
-            menu_loop()
 
 
 menu = OrderedDict([
@@ -234,6 +288,9 @@ menu = OrderedDict([
     ('e', exit_program)
 ])
 
+MENU_PROMPT = "\n".join('{}) {}'.format(key, value.__doc__) for key, value in menu.items())
+VALID = frozenset(menu)
+
 
 if __name__ == '__main__':
     initialize()